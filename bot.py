@@ -11,26 +11,34 @@ async def main() -> None:
     core = Core()
     db_prisma = core._client
     print("(bot) Connecting to database...")
-    await db_prisma.connect()
+    await core.connect()
     print("(bot) Deleting all messages...")
     await db_prisma.message.delete_many()
-    system_message = await core.append(
+    system_message, user_message, assistant_message = await core.append_chain(
         None,
-        AppendOption(role=SYSTEM, content="You are a helpful assistant."),
+        [
+            AppendOption(role=SYSTEM, content="You are a helpful assistant."),
+            AppendOption(role=USER, content="Count from 0 to 9."),
+            AppendOption(role=ASSISTANT),
+        ],
     )
     print(f"(bot) system_message: {system_message}")
-    user_message = await core.append(
-        system_message,
-        AppendOption(role=USER, content="Count from 0 to 9."),
-    )
     print(f"(bot) user_message: {user_message}")
-    assistant_message = await core.append(user_message, AppendOption(role=ASSISTANT))
     print(f"(bot) assistant_message before generating token: {assistant_message}")
-    async for token in assistant_message:
-        print(f"(bot) Generated token: {token}")
-    print(f"(bot) assistant_message after generating token: {assistant_message}")
-    await asyncio.sleep(30)
-    await db_prisma.disconnect()
+
+    async def consume() -> None:
+        async for token in assistant_message:
+            print(f"(bot) Generated token: {token}")
+
+    try:
+        # Stream the tokens while the generation is still being written to the database.
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(consume())
+            tg.create_task(core.join())
+        print(f"(bot) assistant_message after generating token: {assistant_message}")
+    finally:
+        await core.close()
+        await core.disconnect()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,18 @@
 import asyncio
-import time
+import logging
+import os
 import uuid
-from asyncio import Queue
-from contextlib import asynccontextmanager
+import weakref
+from collections import deque
 from dataclasses import dataclass
 from types import TracebackType
-from typing import Dict, Type
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Set, Tuple, Type
 
 from milu.db.prisma import Prisma
 from milu.db.prisma.models import Message as PrismaMessage
-from milu.db.prisma.types import (
-    MessageUpdateInput,
-    MessageWhereUniqueInput,
-)
+from milu.db.prisma.types import MessageCreateInput, MessageUpdateInput
+
+logger = logging.getLogger(__name__)
 
 PENDING = "pending"
 GENERATING = "generating"
@@ -21,37 +21,331 @@ ERROR = "error"
 USER = "user"
 ASSISTANT = "assistant"
 SYSTEM = "system"
+CONNECTION_LIMIT = 20
+READ_CONNECTION_LIMIT = 10
+BULK_WINDOW = 0.005
+BULK_MAX_BATCH = 64
+BULK_MAX_IN_FLIGHT = 4
+ID_POOL_SIZE = 256
+
+
+def _pooled_url(url: str, connection_limit: int) -> str:
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}connection_limit={connection_limit}&pool_timeout=0"
+
+
+# All the Core instances share one client for writes and one for reads, so that
+# lookups are not queued behind the writes in the same connection pool.
+_DATABASE_URL = os.environ.get("DATABASE_URL")
+_CLIENT = Prisma(
+    auto_register=True,
+    datasource=(
+        {"url": _pooled_url(_DATABASE_URL, CONNECTION_LIMIT)} if _DATABASE_URL else None
+    ),
+)
+_READ_CLIENT = Prisma(
+    datasource=(
+        {"url": _pooled_url(_DATABASE_URL, READ_CONNECTION_LIMIT)}
+        if _DATABASE_URL
+        else None
+    ),
+)
+# The shared clients stay connected while any Core is connected. The lock is created
+# on first use, so that it is not bound to an event loop at import time.
+_connect_lock: asyncio.Lock | None = None
+_connected_cores = 0
+
+
+def _get_connect_lock() -> asyncio.Lock:
+    global _connect_lock
+    if _connect_lock is None:
+        _connect_lock = asyncio.Lock()
+    return _connect_lock
+
+# IDs generated on the client are taken from a pool refilled with one os.urandom call.
+# They are formatted like the uuid() default of the schema.
+_id_pool: deque[str] = deque()
+
+
+def _new_id() -> str:
+    if not _id_pool:
+        entropy = os.urandom(16 * ID_POOL_SIZE)
+        _id_pool.extend(
+            str(uuid.UUID(bytes=entropy[i : i + 16], version=4))
+            for i in range(0, len(entropy), 16)
+        )
+    return _id_pool.popleft()
+
+
+# Updates are sent as one raw UPDATE statement, instead of the transaction and SELECT
+# that Prisma wraps around a typed update. The messages only ever update these fields,
+# mapped to their columns. The parent relation is written through its parent_id
+# column, so a compound update of the fields is still a single statement.
+_UPDATE_COLUMNS = {
+    "content": "content",
+    "status": "status",
+    "external_id": "external_id",
+    "parent": "parent_id",
+}
 
 
-@dataclass
+def _parent_id_of(parent: Dict[str, Any]) -> str | None:
+    # The parent update is either {"disconnect": True} or {"connect": {"id": ...}}.
+    connect = parent.get("connect")
+    return None if connect is None else connect["id"]
+
+
+# For each role: whether the message has a parent, whether it has content, and the
+# errors raised when either does not hold.
+_ROLE_RULES = {
+    SYSTEM: (
+        False,
+        True,
+        "The parent of a system message must be None.",
+        "The content of a system message cannot be None.",
+    ),
+    USER: (
+        True,
+        True,
+        "The parent of a user message cannot be None.",
+        "The content of a user message cannot be None.",
+    ),
+    ASSISTANT: (
+        True,
+        False,
+        "The parent of an assistant message cannot be None.",
+        "The content of an assistant message must be None.",
+    ),
+}
+
+# Shared by every update disconnecting a parent, it must not be mutated.
+_DISCONNECT_PARENT = {"disconnect": True}
+_REPR_FMT = (
+    "Message(id={id}, role={role}, content={content}, "
+    "status={status}, external_id={external_id})"
+)
+
+
+def _validate(parent: "Message | str | None", opt: "AppendOption") -> str | None:
+    """
+    Check a message to append against the rules of its role.
+    :param parent: the parent message object or the source ID of the message.
+    :param opt: the options of the message.
+    :return: the ID of the parent message.
+    """
+    parent_id = getattr(parent, "id", parent)
+    rules = _ROLE_RULES.get(opt.role)
+    if rules is None:
+        raise Exception("Invalid message role.")
+    has_parent, has_content, parent_error, content_error = rules
+    if (parent_id is not None) != has_parent:
+        raise Exception(parent_error)
+    if (opt.content is not None) != has_content:
+        raise Exception(content_error)
+    return parent_id
+
+
+@dataclass(slots=True)
 class AppendOption:
     role: str
     content: str | None = None
     external_id: str | None = None
 
 
+# Marks a staged field that has not been set.
+_UNSET: Any = object()
+
+
+@dataclass(slots=True)
+class _Staged:
+    """
+    The changes made to the fields of a message that are not written yet.
+    """
+
+    parent: Dict[str, Any] = _UNSET
+    status: str | None = _UNSET
+    external_id: str | None = _UNSET
+
+    def take(self) -> MessageUpdateInput:
+        """
+        Build the update of the staged fields and unset them.
+        """
+        data: MessageUpdateInput = {}
+        if self.parent is not _UNSET:
+            data["parent"] = self.parent
+            self.parent = _UNSET
+        if self.status is not _UNSET:
+            data["status"] = self.status
+            self.status = _UNSET
+        if self.external_id is not _UNSET:
+            data["external_id"] = self.external_id
+            self.external_id = _UNSET
+        return data
+
+
+class _WriteCoalescer:
+    """
+    Keeps at most one write of a message in flight. The changes made while a write
+    is in flight are sent together by the next one.
+    """
+
+    __slots__ = ("_flush", "_dirty", "_closing", "_waiters", "_task")
+
+    def __init__(
+        self, flush: Callable[[], Awaitable[None]], task_group: asyncio.TaskGroup
+    ):
+        self._flush = flush
+        self._dirty = asyncio.Event()
+        self._closing = False
+        self._waiters: List[asyncio.Future[None]] = []
+        self._task = task_group.create_task(self._flusher())
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    async def flush(self):
+        """
+        Wait until the changes made so far are written.
+        """
+        if self._task.done():
+            # The writer failed, the task group raises the error on exit.
+            return
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._dirty.set()
+        await waiter
+
+    def close(self):
+        """
+        Write the remaining changes and stop the writer.
+        """
+        self._closing = True
+        self._dirty.set()
+
+    async def wait_closed(self):
+        """
+        Wait until the writer is stopped. A failed write is raised by the task group
+        running the writer, not here.
+        """
+        await asyncio.wait((self._task,))
+
+    def failed(self) -> bool:
+        """
+        Whether the writer stopped because a write failed.
+        """
+        return (
+            self._task.done()
+            and not self._task.cancelled()
+            and self._task.exception() is not None
+        )
+
+    async def _flusher(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            closing = self._closing
+            waiters, self._waiters = self._waiters, []
+            try:
+                await self._flush()
+            except BaseException:
+                # The task group cancels the waiting task and raises the error.
+                for waiter in waiters:
+                    waiter.cancel()
+                raise
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            if closing:
+                return
+
+
 class Message:
+    # The fields of the row are copied into slots, so reading them does not go
+    # through the Prisma model.
+    __slots__ = (
+        "_core",
+        "_id",
+        "_role",
+        "_parent_id",
+        "_status",
+        "_external_id",
+        "_chunks",
+        "_content_cache",
+        "_content_dirty",
+        "_cursor",
+        "_ready",
+        "_done",
+        "_staged",
+        "_task_group",
+        "_writer",
+        "__weakref__",
+    )
+
     def __init__(
         self,
         prisma_message: PrismaMessage,
+        core: "Core",
     ):
-        self._prisma_message: PrismaMessage = prisma_message
-        self._data: MessageUpdateInput | None = None
-        self._tokens: Queue[str | None] = Queue()
+        self._core = core
+        self._id: str = prisma_message.id
+        self._role: str | None = prisma_message.role
+        self._parent_id: str | None = prisma_message.parent_id
+        self._status: str | None = prisma_message.status
+        self._external_id: str | None = prisma_message.external_id
+        self._chunks: List[str] = []
+        if prisma_message.content is not None:
+            self._chunks.append(prisma_message.content)
+        self._content_cache: str | None = prisma_message.content
+        self._content_dirty = False
+        # The consumers read the tokens straight from the chunks, after the content
+        # the message was loaded with.
+        self._cursor = len(self._chunks)
+        self._ready = asyncio.Event()
+        # Only the messages generated by their core have tokens left to come, a row
+        # left generating by another process is never appended to here.
+        self._done = True
+        self._staged = _Staged()
+        self._task_group: asyncio.TaskGroup | None = None
+        self._writer: _WriteCoalescer | None = None
 
     def __aiter__(self):
         return self
 
     async def __anext__(self) -> str:
-        next_token = await self._tokens.get()
-        if next_token is None:
+        if not await self._wait_tokens():
             raise StopAsyncIteration
+        next_token = self._chunks[self._cursor]
+        self._cursor += 1
         return next_token
 
+    async def iter_chunks(self) -> AsyncIterator[str]:
+        """
+        Iterate over the generated tokens like the message itself, but yield all the
+        tokens appended since the previous chunk joined together, so a slow consumer
+        is woken up once per chunk instead of once per token.
+        """
+        while await self._wait_tokens():
+            end = len(self._chunks)
+            chunk = "".join(self._chunks[self._cursor : end])
+            self._cursor = end
+            yield chunk
+
+    async def _wait_tokens(self) -> bool:
+        # Returns False once all the tokens have been read and the message is finished.
+        while self._cursor == len(self._chunks):
+            if self._done:
+                return False
+            self._ready.clear()
+            await self._ready.wait()
+        return True
+
     async def __aenter__(self):
-        if self._data is not None:
+        if self._writer is not None:
             raise Exception("The message is already in the context.")
-        self._data = {}
+        # A failed write cancels the body of the context through the task group.
+        self._task_group = asyncio.TaskGroup()
+        await self._task_group.__aenter__()
+        self._writer = _WriteCoalescer(self._flush, self._task_group)
         return self
 
     async def __aexit__(
@@ -60,135 +354,342 @@ class Message:
         exc_val: Type[Exception] | None,
         exc_tb: TracebackType | None,
     ):
-        if self._data is None:
+        if self._writer is None:
             raise Exception("The message is not in the context.")
-        if exc_type is not None:
-            print(exc_type)
-            print(exc_val)
-            print(exc_tb)
-        await self._update_async(self._data, None)
-        self._data = None
+        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            # Cancelling the generations is the normal way to shut the core down.
+            logger.debug("The context of message %s was cancelled.", self._id)
+        elif exc_type is not None:
+            logger.error(
+                "Error in the context of message %s.",
+                self._id,
+                exc_info=(exc_type, exc_val, exc_tb),
+            )
+        self._writer.close()
+        try:
+            # The error of the body is raised unchanged, unless a write failed.
+            group_exc: Tuple[Any, Any, Any] = (None, None, None)
+            try:
+                # The pending changes are written before the task group is exited,
+                # since exiting it with an error would cancel the writer.
+                await self._writer.wait_closed()
+            except asyncio.CancelledError as e:
+                # The task group stops the writer and raises the cancellation.
+                group_exc = (type(e), e, e.__traceback__)
+            if self._writer.failed():
+                # The task group raises the failed write with the error of the body,
+                # and uncancels the task it cancelled to stop the body.
+                group_exc = (exc_type, exc_val, exc_tb)
+            await self._task_group.__aexit__(*group_exc)
+        finally:
+            self._task_group = None
+            self._writer = None
+            # The consumers stop waiting for tokens even if the body did not finish.
+            self._done = True
+            self._ready.set()
 
     def __repr__(self):
-        return (
-            f"Message(id={self.id}, role={self.role}, content={self.content}, "
-            f"status={self.status}, external_id={self.external_id})"
+        return _REPR_FMT.format_map(
+            {
+                "id": self._id,
+                "role": self._role,
+                "content": self.content,
+                "status": self._status,
+                "external_id": self._external_id,
+            }
         )
 
-    @asynccontextmanager
-    async def append_token(self):
-        token_queue: Queue[str | None] = Queue()
-
-        async def task():
-            content = ""
-            token_count = 0
-            COMMIT_TOKEN_LIMIT = 5
-            COMMIT_TIME_LIMIT = 3
-            db_last_update_time = time.monotonic()
-            get_new_token = asyncio.create_task(token_queue.get())
-            update_db_content = None
-            pending = {get_new_token}
-            while True:
-                done, pending = await asyncio.wait(
-                    pending,
-                    return_when=asyncio.FIRST_COMPLETED,
-                )
-                if get_new_token in done:
-                    new_token = get_new_token.result()
-                    if new_token is None:
-                        await self._tokens.put(None)
-                        break
-                    content += new_token
-                    token_count += 1
-                    await self._tokens.put(new_token)
-                    get_new_token = asyncio.create_task(token_queue.get())
-                    pending.add(get_new_token)
-                if update_db_content in done:
-                    update_db_content = None
-                # Write the content of the message to the database every 3 seconds or 5 tokens.
-                if update_db_content is None and (
-                    time.monotonic() - db_last_update_time >= COMMIT_TIME_LIMIT
-                    or token_count % COMMIT_TOKEN_LIMIT == 0
-                ):
-                    update_db_content = asyncio.create_task(
-                        self._prisma_message.prisma().update(
-                            data={"content": content},
-                            where={"id": self.id},
-                        )
-                    )
-                    pending.add(update_db_content)
-                    db_last_update_time = time.monotonic()
-            if update_db_content is not None:
-                await update_db_content
-            return content
-        tasks = asyncio.create_task(task())
-        try:
-            yield token_queue
-        finally:
-            await token_queue.put(None)
-            current_content = await tasks
-            await self._update_async({"content": current_content}, None)
+    async def append_token(self, token: str):
+        """
+        Append a generated token to the message and pass it to the consumers.
+        The content is written to the database by the writer of the context.
+        :param token: the generated token.
+        """
+        if self._writer is None:
+            raise Exception("The message is not in the context.")
+        self._chunks.append(token)
+        self._content_cache = None
+        self._content_dirty = True
+        self._ready.set()
+        self._writer.mark_dirty()
+
+    async def finish(self):
+        """
+        Write the remaining changes and mark the end of the generated tokens.
+        """
+        if self._writer is not None:
+            await self._writer.flush()
+        self._done = True
+        self._ready.set()
 
     @property
     def id(self) -> str:
-        return self._prisma_message.id
+        return self._id
 
     @property
     def role(self) -> str | None:
-        return self._prisma_message.role
+        return self._role
 
     @property
     def content(self) -> str | None:
-        return self._prisma_message.content
+        # The tokens are joined once per read instead of once per token.
+        if self._content_cache is None and self._chunks:
+            self._content_cache = "".join(self._chunks)
+        return self._content_cache
 
     @property
     def parent_id(self) -> str | None:
-        return self._prisma_message.parent_id
+        return self._parent_id
 
     @parent_id.setter
     def parent_id(self, value: str | None):
-        if self._data is None:
+        if self._writer is None:
             raise Exception("The message is not in the context.")
-        if value is None:
-            self._data["parent"] = {"disconnect": True}
-        else:
-            self._data["parent"] = {"connect": {"id": value}}
+        self._staged.parent = (
+            _DISCONNECT_PARENT if value is None else {"connect": {"id": value}}
+        )
+        self._writer.mark_dirty()
 
     @property
     def status(self) -> str | None:
-        return self._prisma_message.status
+        return self._status
 
     @status.setter
     def status(self, value: str | None):
-        if self._data is None:
+        if self._writer is None:
             raise Exception("The message is not in the context.")
-        self._data["status"] = value
+        self._staged.status = value
+        self._writer.mark_dirty()
 
     @property
     def external_id(self) -> str | None:
-        return self._prisma_message.external_id
+        return self._external_id
 
     @external_id.setter
     def external_id(self, value: str):
-        if self._data is None:
+        if self._writer is None:
             raise Exception("The message is not in the context.")
-        self._data["external_id"] = value
+        self._staged.external_id = value
+        self._writer.mark_dirty()
 
-    async def _update_async(
-        self, data: MessageUpdateInput, condition: MessageWhereUniqueInput | None = None
+    async def _flush(self):
+        data = self._staged.take()
+        if self._content_dirty:
+            self._content_dirty = False
+            data["content"] = self.content
+        if data:
+            await self._update_async(data)
+
+    async def _update_async(self, data: MessageUpdateInput):
+        await self._core._writer.update(self.id, data)
+        # A raw statement returns no row. The content is already held locally.
+        if "status" in data:
+            self._status = data["status"]
+        if "external_id" in data:
+            self._external_id = data["external_id"]
+        if "parent" in data:
+            self._parent_id = _parent_id_of(data["parent"])
+
+
+# A pending write: the ID of the message to update, or None to create one, the data,
+# and the future resolved with the created row, or None for an update.
+_Write = Tuple[
+    str | None,
+    MessageCreateInput | MessageUpdateInput,
+    asyncio.Future[PrismaMessage | None],
+]
+
+
+class _BulkWriter:
+    """
+    Collects the writes issued within a short window and sends them to the database
+    in one transaction. A window is flushed early once it holds max_batch writes, and
+    at most max_in_flight windows are written at the same time.
+    """
+
+    __slots__ = (
+        "_client",
+        "_window",
+        "_max_batch",
+        "_pending",
+        "_timer",
+        "_tasks",
+        "_in_flight",
+    )
+
+    def __init__(
+        self,
+        client: Prisma,
+        window: float = BULK_WINDOW,
+        max_batch: int = BULK_MAX_BATCH,
+        max_in_flight: int = BULK_MAX_IN_FLIGHT,
     ):
-        if condition is None:
-            condition = {"id": self.id}
-        await self._prisma_message.prisma().update(data=data, where=condition)
-        result = await self._prisma_message.prisma().find_unique(where=condition)
-        if result is not None:
-            self._prisma_message = result
+        self._client = client
+        self._window = window
+        self._max_batch = max_batch
+        self._pending: List[_Write] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    def create(self, data: MessageCreateInput) -> asyncio.Future[PrismaMessage | None]:
+        """
+        Queue the creation of a message.
+        :param data: the data of the message.
+        """
+        return self._enqueue(None, data)
+
+    def update(
+        self, message_id: str, data: MessageUpdateInput
+    ) -> asyncio.Future[PrismaMessage | None]:
+        """
+        Queue an update of a message. The update is sent as a raw statement, so the
+        future is resolved with None.
+        :param message_id: the ID of the message to update.
+        :param data: the data to update.
+        """
+        if not data:
+            # Nothing to write, and an empty raw UPDATE would not even be valid SQL.
+            future: asyncio.Future[PrismaMessage | None] = (
+                asyncio.get_running_loop().create_future()
+            )
+            future.set_result(None)
+            return future
+        return self._enqueue(message_id, data)
+
+    async def create_chain(self, payloads: List[MessageCreateInput]):
+        """
+        Create messages referencing each other in one batch. The batch counts as a
+        window in flight, but it is not merged into one: the writes of a window may
+        be retried one by one and the windows are written concurrently, so a chain
+        could be split and a message inserted before its parent.
+        :param payloads: the data of the messages, each parent before its children.
+        """
+        async with self._in_flight:
+            async with self._client.batch_() as batcher:
+                for payload in payloads:
+                    batcher.message.create(payload)
+
+    def _enqueue(
+        self, message_id: str | None, data: MessageCreateInput | MessageUpdateInput
+    ) -> asyncio.Future[PrismaMessage | None]:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[PrismaMessage | None] = loop.create_future()
+        self._pending.append((message_id, data, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        writes, self._pending = self._pending, []
+        task = asyncio.create_task(self._write(writes))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, writes: List[_Write]):
+        async with self._in_flight:
+            if len(writes) > 1:
+                try:
+                    async with self._client.tx() as tx:
+                        results = [
+                            await self._write_one(tx, message_id, data)
+                            for message_id, data, _ in writes
+                        ]
+                except Exception:
+                    # The writes of a window belong to unrelated messages, and one
+                    # failed write rolls back all of them. They are retried one by
+                    # one below, so that the failure only reaches its own future.
+                    pass
+                else:
+                    for (_, _, future), result in zip(writes, results):
+                        if not future.done():
+                            future.set_result(result)
+                    return
+            for message_id, data, future in writes:
+                try:
+                    result = await self._write_one(self._client, message_id, data)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+
+    @staticmethod
+    async def _write_one(
+        client: Prisma,
+        message_id: str | None,
+        data: MessageCreateInput | MessageUpdateInput,
+    ) -> PrismaMessage | None:
+        if message_id is None:
+            return await client.message.create(data)
+        columns = []
+        values = []
+        for key, value in data.items():
+            columns.append(f"`{_UPDATE_COLUMNS[key]}` = ?")
+            values.append(_parent_id_of(value) if key == "parent" else value)
+        count = await client.execute_raw(
+            f"UPDATE `messages` SET {', '.join(columns)} WHERE `id` = ?",
+            *values,
+            message_id,
+        )
+        # The MySQL connector of Prisma counts the matched rows rather than the
+        # changed ones, so 0 means that the message does not exist.
+        if count == 0:
+            raise Exception("The message to update does not exist.")
+        return None
 
 
 class Core:
     def __init__(self):
-        self._messages: Dict[str, Message] = {}
-        self._client = Prisma(auto_register=True)
+        # Messages are dropped once nothing else references them.
+        self._messages: weakref.WeakValueDictionary[
+            str, Message
+        ] = weakref.WeakValueDictionary()
+        self._client = _CLIENT
+        self._read_client = _READ_CLIENT
+        self._writer = _BulkWriter(self._client)
+        self._read_batch: List[Tuple[str, asyncio.Future[Message | None]]] = []
+        self._read_scheduled = False
+        self._read_tasks: Set[asyncio.Task] = set()
+        self._generations: Set[asyncio.Task] = set()
+        self._connected = False
+
+    async def connect(self):
+        """
+        Connect the shared database clients if they are not connected yet, so that
+        the first messages do not wait for the connections to be opened.
+        """
+        global _connected_cores
+        async with _get_connect_lock():
+            for client in (self._client, self._read_client):
+                if not client.is_connected():
+                    await client.connect()
+            if not self._connected:
+                self._connected = True
+                _connected_cores += 1
+
+    async def disconnect(self):
+        """
+        Release the shared database clients, which are disconnected once no Core is
+        connected anymore.
+        """
+        global _connected_cores
+        async with _get_connect_lock():
+            if not self._connected:
+                return
+            self._connected = False
+            _connected_cores -= 1
+            if _connected_cores:
+                return
+            for client in (self._client, self._read_client):
+                if client.is_connected():
+                    await client.disconnect()
 
     async def append(self, parent: Message | str | None, opt: AppendOption) -> Message:
         """
@@ -196,50 +697,138 @@ class Core:
         :param parent: the parent message object or the source ID of the message.
         :param opt: the options of the message.
         """
-        if opt.role == SYSTEM:
-            if parent is not None:
-                raise Exception("The parent of a system message must be None.")
-            if opt.content is None:
-                raise Exception("The content of a system message cannot be None.")
-        elif opt.role == USER:
-            if parent is None:
-                raise Exception("The parent of a user message cannot be None.")
-            if opt.content is None:
-                raise Exception("The content of a user message cannot be None.")
-        elif opt.role == ASSISTANT:
-            if parent is None:
-                raise Exception("The parent of an assistant message cannot be None.")
-            if opt.content is not None:
-                raise Exception("The content of an assistant message must be None.")
-        else:
-            raise Exception("Invalid message role.")
-        parent_id = parent.id if isinstance(parent, Message) else parent
+        parent_id = _validate(parent, opt)
         new_message = Message(
-            await self._client.message.create(
+            await self._writer.create(
                 {
-                    "id": str(uuid.uuid4()),
                     "role": opt.role,
                     "content": opt.content,
                     "parent_id": parent_id,
-                    "status": None,
+                    "status": PENDING if opt.role == ASSISTANT else None,
                     "external_id": opt.external_id,
                 }
-            )
+            ),
+            self,
         )
-        if opt.role == ASSISTANT:
-            async with new_message as m:
-                m.status = PENDING
-            task = asyncio.create_task(fake_api(new_message))
-        self._messages[new_message.id] = new_message
+        self._register(new_message)
         return new_message
 
+    async def append_chain(
+        self, parent: Message | str | None, opts: List[AppendOption]
+    ) -> List[Message]:
+        """
+        Append a chain of messages, each one being the parent of the next one. All
+        the messages are inserted in one batch.
+        :param parent: the parent message object or the source ID of the first message.
+        :param opts: the options of the messages.
+        """
+        parent_id = getattr(parent, "id", parent)
+        payloads: List[MessageCreateInput] = []
+        for opt in opts:
+            _validate(parent_id, opt)
+            # The IDs are generated here to link the messages before they are inserted.
+            message_id = _new_id()
+            payloads.append(
+                {
+                    "id": message_id,
+                    "role": opt.role,
+                    "content": opt.content,
+                    "parent_id": parent_id,
+                    "status": PENDING if opt.role == ASSISTANT else None,
+                    "external_id": opt.external_id,
+                }
+            )
+            parent_id = message_id
+        if not payloads:
+            return []
+        await self._writer.create_chain(payloads)
+        new_messages = [Message(PrismaMessage(**payload), self) for payload in payloads]
+        for new_message in new_messages:
+            self._register(new_message)
+        return new_messages
+
+    async def load(self, message_id: str) -> Message | None:
+        """
+        Load a message by its ID. The messages loaded in the same tick of the event
+        loop are read from the database in one query.
+        :param message_id: the ID of the message.
+        """
+        message = self._messages.get(message_id)
+        if message is not None:
+            return message
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Message | None] = loop.create_future()
+        self._read_batch.append((message_id, future))
+        if not self._read_scheduled:
+            self._read_scheduled = True
+            loop.call_soon(self._flush_reads)
+        return await future
+
+    async def join(self):
+        """
+        Wait until the assistant messages are generated and written to the database.
+        """
+        while self._generations:
+            await asyncio.gather(*self._generations)
+
+    async def close(self):
+        """
+        Cancel the generations that are still running and wait until they stop.
+        """
+        for task in self._generations:
+            task.cancel()
+        await asyncio.gather(*self._generations, return_exceptions=True)
+
+    def _register(self, message: Message):
+        if message.role == ASSISTANT:
+            message._done = False
+            task = asyncio.create_task(fake_api(message))
+            self._generations.add(task)
+            task.add_done_callback(self._generations.discard)
+        self._messages[message.id] = message
+
+    def _flush_reads(self):
+        self._read_scheduled = False
+        reads, self._read_batch = self._read_batch, []
+        task = asyncio.create_task(self._read(reads))
+        self._read_tasks.add(task)
+        task.add_done_callback(self._read_tasks.discard)
+
+    async def _read(self, reads: List[Tuple[str, asyncio.Future[Message | None]]]):
+        try:
+            rows = await self._read_client.message.find_many(
+                where={"id": {"in": list({message_id for message_id, _ in reads})}}
+            )
+        except Exception as e:
+            for _, future in reads:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        rows_by_id = {row.id: row for row in rows}
+        for message_id, future in reads:
+            if future.done():
+                continue
+            # Another load or append may have registered the message meanwhile.
+            message = self._messages.get(message_id)
+            if message is None and message_id in rows_by_id:
+                message = Message(rows_by_id[message_id], self)
+                self._messages[message_id] = message
+            future.set_result(message)
+
 
 async def fake_api(message: Message):
     async with message as mess_editor:
-        mess_editor.status = GENERATING
-        async with mess_editor.append_token() as q:
+        try:
             for i in range(10):
-                await q.put(str(i))
+                await mess_editor.append_token(str(i))
+                if i == 0:
+                    # Written together with the content of the first token.
+                    mess_editor.status = GENERATING
                 await asyncio.sleep(1)
+        except BaseException:
+            # Written by the context on exit, with the tokens generated so far.
+            mess_editor.status = ERROR
+            raise
+        # Written by the final flush of finish, together with the last tokens.
         mess_editor.status = FINISHED
-    # Write the properties of prism_message to the database.
+        await mess_editor.finish()
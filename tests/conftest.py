@@ -0,0 +1,150 @@
+import sys
+import types
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+# The Prisma client is generated into milu/db by `prisma generate`. The tests only
+# use stubbed clients, so a minimal stand-in is installed when it is not generated.
+try:
+    import milu.db.prisma  # noqa: F401
+except ImportError:
+
+    class Prisma:
+        def __init__(self, **kwargs: Any):
+            self._connected = False
+
+        def is_connected(self) -> bool:
+            return self._connected
+
+        async def connect(self):
+            self._connected = True
+
+        async def disconnect(self):
+            self._connected = False
+
+    class Message:
+        def __init__(self, **fields: Any):
+            self.id = fields.get("id")
+            self.role = fields.get("role")
+            self.content = fields.get("content")
+            self.parent_id = fields.get("parent_id")
+            self.status = fields.get("status")
+            self.external_id = fields.get("external_id")
+
+    prisma = types.ModuleType("milu.db.prisma")
+    prisma.Prisma = Prisma
+    models = types.ModuleType("milu.db.prisma.models")
+    models.Message = Message
+    prisma_types = types.ModuleType("milu.db.prisma.types")
+    prisma_types.MessageCreateInput = Dict[str, Any]
+    prisma_types.MessageUpdateInput = Dict[str, Any]
+    sys.modules["milu.db.prisma"] = prisma
+    sys.modules["milu.db.prisma.models"] = models
+    sys.modules["milu.db.prisma.types"] = prisma_types
+
+from milu.db.prisma.models import Message as PrismaMessage  # noqa: E402
+
+
+class FakeClient:
+    """
+    An in-memory stand-in for the Prisma client, recording the calls made to it.
+    """
+
+    def __init__(self):
+        self.rows: Dict[str, Dict[str, Any]] = {}
+        self.calls: List[Tuple[Any, ...]] = []
+        self.message = _FakeActions(self)
+        self._tx_rows: Dict[str, Dict[str, Any]] | None = None
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def connect(self):
+        self.calls.append(("connect",))
+        self._connected = True
+
+    async def disconnect(self):
+        self.calls.append(("disconnect",))
+        self._connected = False
+
+    @property
+    def _table(self) -> Dict[str, Dict[str, Any]]:
+        return self.rows if self._tx_rows is None else self._tx_rows
+
+    @asynccontextmanager
+    async def tx(self):
+        self.calls.append(("tx",))
+        self._tx_rows = {key: dict(row) for key, row in self.rows.items()}
+        try:
+            yield self
+        except BaseException:
+            self._tx_rows = None
+            raise
+        self.rows, self._tx_rows = self._tx_rows, None
+
+    @asynccontextmanager
+    async def batch_(self):
+        batcher = _FakeBatcher()
+        yield batcher
+        self.calls.append(("batch", len(batcher.message.payloads)))
+        for payload in batcher.message.payloads:
+            self.message.insert(payload)
+
+    async def execute_raw(self, query: str, *args: Any) -> int:
+        self.calls.append(("raw", query, args))
+        *values, message_id = args
+        row = self._table.get(message_id)
+        if row is None:
+            return 0
+        assignments = query.split(" SET ", 1)[1].split(" WHERE ", 1)[0].split(", ")
+        for assignment, value in zip(assignments, values):
+            row[assignment.split("`")[1]] = value
+        return 1
+
+
+class _FakeActions:
+    def __init__(self, client: FakeClient):
+        self._client = client
+
+    def insert(self, data: Dict[str, Any]) -> PrismaMessage:
+        parent_id = data.get("parent_id")
+        if parent_id is not None and parent_id not in self._client._table:
+            raise Exception("Foreign key constraint failed on the field: `parent_id`")
+        row = {"id": str(uuid.uuid4()), **data}
+        self._client._table[row["id"]] = row
+        return PrismaMessage(**row)
+
+    async def create(self, data: Dict[str, Any]) -> PrismaMessage:
+        self._client.calls.append(("create", data.get("id")))
+        return self.insert(data)
+
+    async def find_many(self, where: Dict[str, Any]) -> List[PrismaMessage]:
+        ids = where["id"]["in"]
+        self._client.calls.append(("find_many", sorted(ids)))
+        return [
+            PrismaMessage(**self._client.rows[message_id])
+            for message_id in ids
+            if message_id in self._client.rows
+        ]
+
+
+class _FakeBatcher:
+    def __init__(self):
+        self.message = _FakeBatchActions()
+
+
+class _FakeBatchActions:
+    def __init__(self):
+        self.payloads: List[Dict[str, Any]] = []
+
+    def create(self, data: Dict[str, Any]):
+        self.payloads.append(data)
+
+
+@pytest.fixture
+def client() -> FakeClient:
+    return FakeClient()
@@ -0,0 +1,530 @@
+import asyncio
+import logging
+import re
+import uuid
+
+import pytest
+
+from milu.core import (
+    ASSISTANT,
+    ERROR,
+    FINISHED,
+    GENERATING,
+    SYSTEM,
+    USER,
+    AppendOption,
+    Core,
+    Message,
+    _BulkWriter,
+    _validate,
+    fake_api,
+)
+from milu.db.prisma.models import Message as PrismaMessage
+
+
+def test_bulk_writer_sends_a_window_in_one_transaction(client):
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        first = writer.create({"id": "a", "role": "system", "content": "x"})
+        second = writer.create({"id": "b", "role": "user", "parent_id": "a"})
+        await asyncio.gather(first, second)
+
+    asyncio.run(main())
+    assert client.calls == [("tx",), ("create", "a"), ("create", "b")]
+    assert set(client.rows) == {"a", "b"}
+
+
+def test_bulk_writer_sends_a_single_write_without_transaction(client):
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        await writer.create({"id": "a", "role": "system", "content": "x"})
+
+    asyncio.run(main())
+    assert client.calls == [("create", "a")]
+
+
+def test_bulk_writer_flushes_a_full_window_early(client):
+    async def main():
+        writer = _BulkWriter(client, window=60, max_batch=2)
+        futures = [
+            writer.create({"id": message_id, "role": "system", "content": "x"})
+            for message_id in ("a", "b")
+        ]
+        await asyncio.wait_for(asyncio.gather(*futures), 1)
+
+    asyncio.run(main())
+    assert client.calls == [("tx",), ("create", "a"), ("create", "b")]
+
+
+def test_bulk_writer_keeps_the_order_of_the_writes(client):
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        await writer.create({"id": "a", "role": "assistant", "content": None})
+        first = writer.update("a", {"content": "0"})
+        second = writer.update("a", {"content": "01", "status": "finished"})
+        await asyncio.gather(first, second)
+
+    asyncio.run(main())
+    assert [call[2] for call in client.calls if call[0] == "raw"] == [
+        ("0", "a"),
+        ("01", "finished", "a"),
+    ]
+    assert client.rows["a"]["content"] == "01"
+    assert client.rows["a"]["status"] == "finished"
+
+
+def test_bulk_writer_isolates_a_failed_write(client):
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        await writer.create({"id": "a", "role": "assistant", "content": None})
+        failed = writer.create({"id": "b", "role": "user", "parent_id": "missing"})
+        healthy = writer.update("a", {"status": "finished"})
+        return await asyncio.gather(failed, healthy, return_exceptions=True)
+
+    failed, healthy = asyncio.run(main())
+    assert isinstance(failed, Exception)
+    assert not isinstance(healthy, Exception)
+    assert client.rows["a"]["status"] == "finished"
+    assert "b" not in client.rows
+
+
+def test_bulk_writer_fails_every_write_of_a_broken_connection(client):
+    async def fail(*args):
+        raise ConnectionError("The database is unreachable.")
+
+    client.execute_raw = fail
+
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        futures = [writer.update(message_id, {"status": "x"}) for message_id in "ab"]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+def test_bulk_writer_resolves_an_empty_update_at_once(client):
+    async def main():
+        writer = _BulkWriter(client, window=60)
+        return await asyncio.wait_for(writer.update("a", {}), 1)
+
+    assert asyncio.run(main()) is None
+    assert client.calls == []
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 2])
+def test_bulk_writer_caps_the_windows_in_flight(client, max_in_flight):
+    active = 0
+    peak = 0
+    create = client.message.create
+
+    async def slow_create(data):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return await create(data)
+
+    client.message.create = slow_create
+
+    async def main():
+        writer = _BulkWriter(
+            client, window=0.001, max_batch=1, max_in_flight=max_in_flight
+        )
+        futures = [
+            writer.create({"id": str(i), "role": "system", "content": "x"})
+            for i in range(4)
+        ]
+        await asyncio.gather(*futures)
+
+    asyncio.run(main())
+    assert peak == max_in_flight
+
+
+def test_bulk_writer_fails_the_update_of_a_missing_message(client):
+    async def main():
+        writer = _BulkWriter(client, window=0.01)
+        await writer.create({"id": "a", "role": "system", "content": "x"})
+        missing = writer.update("missing", {"status": "finished"})
+        existing = writer.update("a", {"parent": {"disconnect": True}})
+        return await asyncio.gather(missing, existing, return_exceptions=True)
+
+    missing, existing = asyncio.run(main())
+    assert isinstance(missing, Exception)
+    assert existing is None
+    assert client.calls[-1] == (
+        "raw",
+        "UPDATE `messages` SET `parent_id` = ? WHERE `id` = ?",
+        (None, "a"),
+    )
+
+
+@pytest.mark.parametrize(
+    "role, parent, content, error",
+    [
+        (SYSTEM, None, "x", None),
+        (SYSTEM, None, None, "The content of a system message cannot be None."),
+        (SYSTEM, "p", "x", "The parent of a system message must be None."),
+        (SYSTEM, "p", None, "The parent of a system message must be None."),
+        (USER, "p", "x", None),
+        (USER, "p", None, "The content of a user message cannot be None."),
+        (USER, None, "x", "The parent of a user message cannot be None."),
+        (USER, None, None, "The parent of a user message cannot be None."),
+        (ASSISTANT, "p", None, None),
+        (ASSISTANT, "p", "x", "The content of an assistant message must be None."),
+        (ASSISTANT, None, None, "The parent of an assistant message cannot be None."),
+        (ASSISTANT, None, "x", "The parent of an assistant message cannot be None."),
+        ("tool", "p", "x", "Invalid message role."),
+    ],
+)
+def test_validate_checks_the_rules_of_the_role(role, parent, content, error):
+    opt = AppendOption(role, content)
+    if error is None:
+        assert _validate(parent, opt) == parent
+    else:
+        with pytest.raises(Exception, match=re.escape(error)):
+            _validate(parent, opt)
+
+
+def test_validate_takes_the_id_of_a_parent_message():
+    parent = Message(PrismaMessage(id="p", role=USER, content="Hello"), Core())
+    assert _validate(parent, AppendOption(ASSISTANT)) == "p"
+
+
+async def _assistant(client, message_id="m"):
+    # An assistant message whose writes go through the fake client.
+    core = Core()
+    core._writer = _BulkWriter(client, window=0.001)
+    row = await client.message.create(
+        {"id": message_id, "role": ASSISTANT, "parent_id": None}
+    )
+    message = Message(row, core)
+    # Left open for the tokens, like the messages the core generates.
+    message._done = False
+    return core, message
+
+
+async def _tokens(message):
+    return [token async for token in message]
+
+
+async def _collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_message_coalesces_the_writes_of_the_context(client):
+    async def main():
+        _, message = await _assistant(client)
+        async with message:
+            for token in "abc":
+                await message.append_token(token)
+            message.status = GENERATING
+
+    asyncio.run(main())
+    assert [call[2] for call in client.calls if call[0] == "raw"] == [
+        ("generating", "abc", "m")
+    ]
+
+
+def test_message_writes_the_pending_changes_when_the_body_fails(client):
+    async def main():
+        _, message = await _assistant(client)
+        with pytest.raises(ValueError):
+            async with message:
+                await message.append_token("a")
+                raise ValueError("The generation failed.")
+        return asyncio.current_task().cancelling()
+
+    assert asyncio.run(main()) == 0
+    assert client.rows["m"]["content"] == "a"
+
+
+def test_message_cancels_the_body_when_a_write_fails(client):
+    async def fail(*args):
+        raise ConnectionError("The database is unreachable.")
+
+    async def main():
+        _, message = await _assistant(client)
+        client.execute_raw = fail
+        with pytest.raises(ExceptionGroup) as info:
+            async with message:
+                await message.append_token("a")
+                await asyncio.sleep(60)
+        assert info.group_contains(ConnectionError)
+        return asyncio.current_task().cancelling()
+
+    assert asyncio.run(asyncio.wait_for(main(), 1)) == 0
+
+
+def test_message_raises_a_failed_write_with_the_error_of_the_body(client):
+    async def fail(*args):
+        raise ConnectionError("The database is unreachable.")
+
+    async def main():
+        _, message = await _assistant(client)
+        client.execute_raw = fail
+        with pytest.raises(ExceptionGroup) as info:
+            async with message:
+                await message.append_token("a")
+                raise ValueError("The generation failed.")
+        assert info.group_contains(ConnectionError)
+        assert info.group_contains(ValueError)
+        return asyncio.current_task().cancelling()
+
+    assert asyncio.run(main()) == 0
+
+
+def test_message_raises_a_write_failed_on_exit(client):
+    async def fail(*args):
+        raise ConnectionError("The database is unreachable.")
+
+    async def main():
+        _, message = await _assistant(client)
+        client.execute_raw = fail
+        with pytest.raises(ExceptionGroup) as info:
+            async with message:
+                await message.append_token("a")
+        assert info.group_contains(ConnectionError)
+        return asyncio.current_task().cancelling()
+
+    assert asyncio.run(main()) == 0
+
+
+def test_message_writes_the_pending_changes_when_cancelled(client):
+    async def main():
+        _, message = await _assistant(client)
+        started = asyncio.Event()
+
+        async def generate():
+            async with message:
+                await message.append_token("a")
+                started.set()
+                await asyncio.sleep(60)
+
+        task = asyncio.create_task(generate())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert client.rows["m"]["content"] == "a"
+
+
+def test_message_finish_waits_for_the_final_write(client):
+    async def main():
+        _, message = await _assistant(client)
+        async with message:
+            await message.append_token("a")
+            message.status = FINISHED
+            await message.finish()
+            return dict(client.rows["m"])
+
+    row = asyncio.run(main())
+    assert row["content"] == "a"
+    assert row["status"] == FINISHED
+
+
+def test_message_releases_the_consumers_when_the_body_fails(client):
+    async def main():
+        _, message = await _assistant(client)
+
+        async def consume():
+            return [token async for token in message]
+
+        consumer = asyncio.create_task(consume())
+        with pytest.raises(ValueError):
+            async with message:
+                await message.append_token("a")
+                raise ValueError("The generation failed.")
+        return await asyncio.wait_for(consumer, 1)
+
+    assert asyncio.run(main()) == ["a"]
+
+
+def test_message_iter_chunks_joins_the_tokens_of_a_slow_consumer(client):
+    async def main():
+        _, message = await _assistant(client)
+
+        async def consume():
+            return [chunk async for chunk in message.iter_chunks()]
+
+        consumer = asyncio.create_task(consume())
+        async with message:
+            await message.append_token("0")
+            await asyncio.sleep(0.01)
+            for token in "123":
+                await message.append_token(token)
+            await asyncio.sleep(0.01)
+            await message.finish()
+            chunks = await asyncio.wait_for(consumer, 1)
+        return chunks
+
+    assert asyncio.run(main()) == ["0", "123"]
+
+
+def test_message_iter_chunks_continues_after_the_read_tokens(client):
+    async def main():
+        _, message = await _assistant(client)
+        async with message:
+            for token in "012":
+                await message.append_token(token)
+            first = await anext(message)
+            await message.finish()
+            rest = await asyncio.wait_for(_collect(message.iter_chunks()), 1)
+        return first, rest, await asyncio.wait_for(_tokens(message), 1)
+
+    assert asyncio.run(main()) == ("0", ["12"], [])
+
+
+def test_fake_api_writes_the_error_status_when_cancelled(client, caplog):
+    async def main():
+        _, message = await _assistant(client)
+        task = asyncio.create_task(fake_api(message))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert client.rows["m"]["content"] == "0"
+    assert client.rows["m"]["status"] == ERROR
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_message_logs_the_error_of_the_body(client, caplog):
+    async def main():
+        _, message = await _assistant(client)
+        with pytest.raises(ValueError):
+            async with message:
+                raise ValueError("The generation failed.")
+
+    asyncio.run(main())
+    (record,) = caplog.records
+    assert record.levelno == logging.ERROR
+    assert record.exc_info[0] is ValueError
+
+
+def test_core_appends_a_chain_in_one_batch(client):
+    async def main():
+        core = Core()
+        core._writer = _BulkWriter(client, window=0.001)
+        messages = await core.append_chain(
+            None,
+            [AppendOption(SYSTEM, "You are helpful."), AppendOption(USER, "Hello")],
+        )
+        return messages, [m is await core.load(m.id) for m in messages]
+
+    (system, user), cached = asyncio.run(main())
+    assert client.calls == [("batch", 2)]
+    assert cached == [True, True]
+    assert user.parent_id == system.id
+    assert client.rows[user.id]["parent_id"] == system.id
+    for message in (system, user):
+        assert str(uuid.UUID(message.id)) == message.id
+
+
+def test_core_loads_the_messages_of_a_tick_in_one_query(client):
+    client.rows["a"] = {
+        "id": "a",
+        "role": ASSISTANT,
+        "content": "01",
+        "status": FINISHED,
+    }
+    client.rows["b"] = {"id": "b", "role": USER, "content": "Hello"}
+
+    async def main():
+        core = Core()
+        core._read_client = client
+        a, b, missing = await asyncio.gather(
+            core.load("a"), core.load("b"), core.load("missing")
+        )
+        tokens = await asyncio.wait_for(_tokens(a), 1)
+        return a, b, missing, tokens, await core.load("a") is a
+
+    a, b, missing, tokens, cached = asyncio.run(main())
+    assert client.calls == [("find_many", ["a", "b", "missing"])]
+    assert (a.content, b.content, missing) == ("01", "Hello", None)
+    assert tokens == [] and cached
+
+
+def test_core_loads_a_message_left_generating_as_done(client):
+    client.rows["a"] = {
+        "id": "a",
+        "role": ASSISTANT,
+        "content": "01",
+        "status": GENERATING,
+    }
+
+    async def main():
+        core = Core()
+        core._read_client = client
+        message = await core.load("a")
+        return await asyncio.wait_for(_tokens(message), 1)
+
+    assert asyncio.run(main()) == []
+
+
+def test_core_keeps_the_shared_clients_connected_for_the_other_cores(client):
+    async def main():
+        cores = [Core(), Core()]
+        for core in cores:
+            core._client = core._read_client = client
+            await core.connect()
+        await cores[0].disconnect()
+        await cores[0].disconnect()
+        still_connected = client.is_connected()
+        await cores[1].disconnect()
+        return still_connected
+
+    assert asyncio.run(main())
+    assert not client.is_connected()
+    assert client.calls == [("connect",), ("disconnect",)]
+
+
+@pytest.fixture
+def fast_sleep(monkeypatch):
+    # The fake generation sleeps a second per token.
+    sleep = asyncio.sleep
+
+    async def fast(delay, result=None):
+        return await sleep(min(delay, 0.001), result)
+
+    monkeypatch.setattr(asyncio, "sleep", fast)
+
+
+async def _generate(client):
+    # Start the generation of an assistant message answering a user message.
+    core = Core()
+    core._writer = _BulkWriter(client, window=0.001)
+    _, user = await core.append_chain(
+        None, [AppendOption(SYSTEM, "You are helpful."), AppendOption(USER, "Hello")]
+    )
+    return core, await core.append(user, AppendOption(ASSISTANT))
+
+
+def test_core_join_waits_for_the_final_write(client, fast_sleep):
+    async def main():
+        core, message = await _generate(client)
+        await asyncio.wait_for(core.join(), 1)
+        return dict(client.rows[message.id]), core._generations
+
+    row, generations = asyncio.run(main())
+    assert row["content"] == "0123456789"
+    assert row["status"] == FINISHED
+    assert not generations
+
+
+def test_core_close_cancels_a_running_generation(client, fast_sleep):
+    async def main():
+        core, message = await _generate(client)
+        while not message.content:
+            await asyncio.sleep(0)
+        await asyncio.wait_for(core.close(), 1)
+        return dict(client.rows[message.id]), core._generations
+
+    row, generations = asyncio.run(main())
+    assert row["status"] == ERROR
+    assert len(row["content"]) < 10
+    assert not generations